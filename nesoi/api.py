@@ -165,11 +165,32 @@ class ServiceHostCollectionResource(WebhookResourceMixin):
         self.model = model
 
     def get(self, router, request, url, srvname=None):
-        """Return a mapping of all known hosts."""
-        hosts = {}
-        for hostname in self.model.hosts(srvname):
-            hosts[hostname] = self.model.host(srvname, hostname)
-        return hosts
+        """Return a mapping of all known hosts.
+
+        If the requester passes its C{zone} and/or C{region} as query
+        arguments, a list of hosts ordered by proximity is returned
+        instead.  C{scope} can be used to limit the list to hosts in
+        the same zone or region.
+        """
+        zone = request.args.get('zone', [None])[0]
+        region = request.args.get('region', [None])[0]
+        scope = request.args.get('scope', [None])[0]
+        if zone is None and region is None:
+            hosts = {}
+            for hostname in self.model.hosts(srvname):
+                hosts[hostname] = self.model.host(srvname, hostname)
+            return hosts
+
+        try:
+            hostnames = self.model.nearby_hosts(srvname, zone, region, scope)
+        except ValueError, ve:
+            return http.BAD_REQUEST, str(ve)
+        hosts = []
+        for hostname in hostnames:
+            host = dict(self.model.host(srvname, hostname))
+            host['hostname'] = hostname
+            hosts.append(host)
+        return {'hosts': hosts}
 
 
 class ServiceCollectionResource(object):
@@ -185,3 +206,43 @@ class ServiceCollectionResource(object):
             services[srvname] = {
                 'hosts': list(self.model.hosts(srvname))}
         return services
+
+
+class ProfileResource(object):
+    """Debug resource that profiles the process on demand."""
+
+    max_seconds = 60
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def get(self, router, request, url):
+        """Profile the process for C{seconds} seconds and return the
+        statistics.
+        """
+        try:
+            seconds = float(request.args.get('seconds', [10])[0])
+        except ValueError:
+            return http.BAD_REQUEST, 'seconds must be a number'
+        if not 0 < seconds <= self.max_seconds:
+            return http.BAD_REQUEST, 'seconds must be between 0 and %d' % (
+                self.max_seconds,)
+        try:
+            d = self.profiler.profile(seconds)
+        except ValueError, ve:
+            return http.CONFLICT, str(ve)
+        # The request takes as long as the profile; it is not slow.
+        request.trace.log_slow = False
+        request.setHeader('content-type', 'text/plain')
+        return d.addCallback(lambda stats: (http.OK, stats))
+
+
+class GarbageCollectionResource(object):
+    """Debug resource that reports garbage collection statistics."""
+
+    def __init__(self, cluster_node):
+        self.cluster_node = cluster_node
+
+    def get(self, router, request, url):
+        """Return the garbage collection statistics."""
+        return self.cluster_node.gc_stats()
@@ -0,0 +1,150 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+
+from txgossip import gossip
+from txgossip.gossip import _address_from_peer_name
+
+
+class Gossiper(gossip.Gossiper):
+    """Gossiper with a tunable gossip round.
+
+    Every C{interval} seconds the gossiper beats its heart and
+    initiates a gossip exchange with C{fanout} randomly selected live
+    peers.  Requests and responses are packed so that they do not
+    grow beyond C{max_packet_size} bytes; digest entries and deltas
+    that do not fit are left for a later round.
+    """
+
+    def __init__(self, clock, participant, address=None, interval=1,
+                 fanout=1, max_packet_size=1400):
+        gossip.Gossiper.__init__(self, clock, participant, address)
+        self.interval = interval
+        self.fanout = fanout
+        self.max_packet_size = max_packet_size
+
+    def startProtocol(self):
+        """Start protocol."""
+        self.name = self._determine_endpoint()
+        self.state.set_name(self.name)
+        self._states[self.name] = self.state
+        # Beat the heart at the same pace as we gossip, so that each
+        # round carries exactly one heartbeat delta.
+        self._heart_beat_timer.start(self.interval, now=True)
+        self._gossip_timer.start(self.interval, now=True)
+        self.participant.make_connection(self)
+
+    def _gossip(self):
+        """Initiate a round of gossiping."""
+        live_peers = self.live_peers
+        dead_peers = self.dead_peers
+        for peer in random.sample(live_peers,
+                                  min(self.fanout, len(live_peers))):
+            self._gossip_with_peer(peer)
+
+        prob = len(dead_peers) / float(len(live_peers) + 1)
+        if random.random() < prob:
+            self._gossip_with_peer(random.choice(dead_peers))
+
+        for state in self._states.values():
+            if state.name != self.name:
+                state.check_suspected()
+
+    def _gossip_with_peer(self, peer):
+        """Send a gossip message to C{peer}."""
+        self.transport.write(self._pack_digest({'type': 'request'},
+            self._scuttle.digest()), _address_from_peer_name(peer.name))
+
+    def _pack_digest(self, message, digest):
+        """Encode C{message} with as many entries of C{digest} as fits
+        in a single packet.
+
+        Peers left out of the digest are simply not exchanged in this
+        round.  Our own entry is always included; the others are
+        picked at random so that every peer gets its turn.
+        """
+        message['digest'] = digest
+        data = json.dumps(message)
+        if len(data) <= self.max_packet_size:
+            return data
+
+        names = [name for name in digest if name != self.name]
+        random.shuffle(names)
+        message['digest'] = packed = {}
+        if self.name in digest:
+            packed[self.name] = digest[self.name]
+        size = len(json.dumps(message))
+        for name in names:
+            # Account for the ', ' and ': ' separators.
+            size += len(json.dumps(name)) + len(json.dumps(digest[name])) + 4
+            if size > self.max_packet_size:
+                break
+            packed[name] = digest[name]
+        return json.dumps(message)
+
+    def _pack(self, message, deltas):
+        """Encode C{message} with as many of C{deltas} as fits in a
+        single packet.
+
+        The deltas of each peer are ordered by version, so sending
+        only a prefix of them is safe: the receiver will ask for the
+        rest in the next round.  When not all deltas fit, they are
+        taken one per peer at a time, with the peers in random order,
+        so that no peer is starved.  At least one delta is always sent
+        so that a single oversized value cannot stall replication.
+        """
+        message['updates'] = deltas
+        data = json.dumps(message)
+        if len(data) <= self.max_packet_size:
+            return data
+
+        queues = {}
+        for delta in deltas:
+            queues.setdefault(delta[0], []).append(delta)
+        queues = queues.values()
+        random.shuffle(queues)
+
+        message['updates'] = updates = []
+        size = len(json.dumps(message))
+        index = 0
+        while queues:
+            queues = [queue for queue in queues if index < len(queue)]
+            for queue in queues:
+                delta = queue[index]
+                size += len(json.dumps(delta)) + (2 if updates else 0)
+                if updates and size > self.max_packet_size:
+                    return json.dumps(message)
+                updates.append(delta)
+            index += 1
+        return json.dumps(message)
+
+    def _handle_request(self, message, address):
+        """Handle an incoming gossip request."""
+        deltas, requests, new_peers = self._scuttle.scuttle(
+            message['digest'])
+        self._handle_new_peers(new_peers)
+        response = self._pack({
+            'type': 'first-response', 'digest': requests
+            }, deltas)
+        self.transport.write(response, address)
+
+    def _handle_first_response(self, message, address):
+        """Handle the response to a request."""
+        self._scuttle.update_known_state(message['updates'])
+        response = self._pack({
+            'type': 'second-response'
+            }, self._scuttle.fetch_deltas(message['digest']))
+        self.transport.write(response, address)
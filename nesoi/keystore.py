@@ -15,10 +15,13 @@
 import json
 
 from twisted.application import service
+from twisted.internet import task
 from twisted.web import client
 from twisted.python import log
 from txgossip.recipies import KeyStoreMixin, LeaderElectionMixin
 
+from nesoi.trace import Tracer
+
 
 class _LeaderElectionProtocol(LeaderElectionMixin):
     """Private version of the leader election protocol that informs
@@ -34,23 +37,219 @@ class _LeaderElectionProtocol(LeaderElectionMixin):
         self._app.leader_elected(is_leader)
 
 
+class _KeyStore(KeyStoreMixin):
+    """Private version of the key-value store that batches writes to
+    the backing storage and that can garbage collect deleted keys.
+
+    Instead of syncing the storage for every updated key, the storage
+    is synced at most once every C{sync_interval} seconds.
+
+    Observers added with L{add_observer} are called with the key and
+    the new value whenever a key in the store changes.
+
+    Deleted keys are kept around as tombstones (keys with a C{None}
+    value) until the cluster has agreed on a garbage collection
+    horizon that covers them.  See L{collect_garbage}.  The deletion
+    time of each collected key is kept in C{collected}, and in the
+    backing storage, so that older values of it are not replicated
+    back from peers.  Entries are dropped by L{prune_collected}.
+    """
+
+    COLLECTED_KEY = 'gc:collected'
+
+    def __init__(self, clock, storage, ignore_keys=[], sync_interval=1,
+                 gc_grace=86400):
+        KeyStoreMixin.__init__(self, clock, storage,
+                               list(ignore_keys) + [self.COLLECTED_KEY])
+        self.sync_interval = sync_interval
+        self.gc_grace = gc_grace
+        self._sync_call = None
+        self.horizon = 0
+        self.reclaimed = 0
+        self.collected = dict(storage.get(self.COLLECTED_KEY, {}))
+        self.observers = []
+
+    def add_observer(self, observer):
+        """Add C{observer} to be called on changes to the store."""
+        self.observers.append(observer)
+
+    def persist_key_value(self, key, timestamped_value):
+        if key in self.collected:
+            del self.collected[key]
+            self._persist_collected()
+        self._storage[key] = timestamped_value
+        self._schedule_sync()
+        for observer in self.observers:
+            observer(key, timestamped_value[1])
+
+    def replicate_key_value(self, peer, key, timestamped_value):
+        timestamp, value = timestamped_value
+        if key in self.collected and timestamp <= self.collected[key]:
+            # We garbage collected the key.  Do not let a peer that
+            # missed the deletion bring it back to life.
+            return
+        if (value is None and not key in self._storage
+                and timestamp <= self.horizon):
+            # A tombstone for a key that we do not know about and that
+            # would be collected right away.
+            return
+        KeyStoreMixin.replicate_key_value(self, peer, key,
+                                          timestamped_value)
+
+    def get(self, key, default=None):
+        # Look the key up directly rather than searching through all
+        # keys like KeyStoreMixin does.
+        timestamped_value = self._gossiper.get(key)
+        if timestamped_value is None:
+            return default
+        return timestamped_value[1]
+
+    def __contains__(self, key):
+        return key in self._gossiper
+
+    def timestamp_for_key(self, key):
+        """Return the time C{key} was last written."""
+        return self._gossiper.get(key)[0]
+
+    def _persist_collected(self):
+        self._storage[self.COLLECTED_KEY] = self.collected
+        self._schedule_sync()
+
+    def _schedule_sync(self):
+        if self._sync_call is None and hasattr(self._storage, 'sync'):
+            self._sync_call = self.clock.callLater(self.sync_interval,
+                                                   self.sync)
+
+    def sync(self):
+        """Write pending changes to the backing storage."""
+        if self._sync_call is not None:
+            if self._sync_call.active():
+                self._sync_call.cancel()
+            self._sync_call = None
+            self._storage.sync()
+
+    def _tombstones(self, state, horizon=None):
+        """Return C{(key, timestamp)} pairs for all tombstones in
+        peer state C{state} that were written at or before
+        C{horizon}.
+        """
+        tombstones = []
+        for key, value in state.items():
+            if key == '__heartbeat__' or key in self._ignore_keys:
+                continue
+            timestamp, value = value
+            if value is None and (horizon is None or timestamp <= horizon):
+                tombstones.append((key, timestamp))
+        return tombstones
+
+    def tombstones(self):
+        """Return C{(key, timestamp)} pairs for all deleted keys that
+        are still kept in the store.
+        """
+        return self._tombstones(self._gossiper.state)
+
+    def collect_garbage(self, horizon):
+        """Purge all tombstones written at or before C{horizon} from
+        the store and the backing storage.
+
+        It is only safe to do this when all peers have observed the
+        deletions.
+
+        @return: The number of tombstones that were reclaimed.
+        """
+        self.horizon = max(self.horizon, horizon)
+        state = self._gossiper.state
+        tombstones = self._tombstones(state, self.horizon)
+        for key, timestamp in tombstones:
+            del state.attrs[key]
+            self.collected[key] = timestamp
+            if key in self._storage:
+                del self._storage[key]
+        # Our copies of the other peers' states hold the same
+        # tombstones.  They will never be read again, so release them
+        # as well.
+        for peer in self._gossiper.live_peers + self._gossiper.dead_peers:
+            for key, timestamp in self._tombstones(peer, self.horizon):
+                del peer.attrs[key]
+        if tombstones:
+            self.reclaimed += len(tombstones)
+            self._persist_collected()
+        return len(tombstones)
+
+    def prune_collected(self):
+        """Forget about collected keys that no peer can bring back.
+
+        An entry is dropped when the key was deleted more than
+        C{gc_grace} seconds ago and none of the peer states we know
+        of holds an older value of it.  Older tombstones do not count
+        since they are never replicated past the horizon.  The grace
+        period keeps the entries around after a restart, before the
+        peer states have been gossiped to us again.
+
+        @return: The number of entries that were dropped.
+        """
+        cutoff = self.clock.seconds() - self.gc_grace
+        peers = self._gossiper.live_peers + self._gossiper.dead_peers
+        pruned = 0
+        for key, timestamp in self.collected.items():
+            if timestamp > cutoff:
+                continue
+            for peer in peers:
+                value = peer.get(key)
+                if (value is not None and value[1] is not None
+                        and value[0] <= timestamp):
+                    break
+            else:
+                del self.collected[key]
+                pruned += 1
+        if pruned:
+            self._persist_collected()
+        return pruned
+
+
 class ClusterNode(service.Service, KeyStoreMixin, LeaderElectionMixin):
     """Gossip participant that both implements our replicated
     key-value store and a leader-election mechanism.
+
+    The leader periodically advances a garbage collection horizon
+    (C{HORIZON_KEY}) up to the newest deletion that all peers have
+    observed.  Dead peers count as well, until they have been dead
+    for C{gc_grace} seconds, so that a node that comes back from a
+    partition learns about deletions before they are collected.
+    Every node purges tombstones that fall behind the horizon when it
+    learns about it.
     """
 
-    def __init__(self, clock, storage, client=client):
+    HORIZON_KEY = 'gc:horizon'
+
+    def __init__(self, clock, storage, client=client, sync_interval=1,
+                 gc_interval=60, gc_grace=86400, tracer=None):
+        self.clock = clock
+        self.tracer = tracer or Tracer(clock)
         self.election = _LeaderElectionProtocol(clock, self)
-        self.keystore = KeyStoreMixin(clock, storage,
+        self.keystore = _KeyStore(clock, storage,
                 [self.election.LEADER_KEY, self.election.VOTE_KEY,
-                 self.election.PRIO_KEY])
+                 self.election.PRIO_KEY], sync_interval=sync_interval,
+                gc_grace=gc_grace)
         self.client = client
         self.storage = storage
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+        self._dead_since = {}
+        self._gc_timer = task.LoopingCall(self.collect_tombstones)
+        self._gc_timer.clock = clock
 
     def startService(self):
         self.keystore.load_from(self.storage)
+        self._gc_timer.start(self.gc_interval, now=False)
         service.Service.startService(self)
 
+    def stopService(self):
+        if self._gc_timer.running:
+            self._gc_timer.stop()
+        self.keystore.sync()
+        return service.Service.stopService(self)
+
     def value_changed(self, peer, key, value):
         """A peer changed one of its values."""
         if key == '__heartbeat__':
@@ -62,6 +261,12 @@ class ClusterNode(service.Service, KeyStoreMixin, LeaderElectionMixin):
             return
         self.keystore.value_changed(peer, key, value)
 
+        if key == self.HORIZON_KEY:
+            if peer.name == self.gossiper.name:
+                timestamp, horizon = value
+                self._collect_garbage(horizon)
+            return
+
         if self.election.is_leader and peer.name == self.gossiper.name:
             # This peer is the leader of the cluster, which means that
             # we're responsible for firing notifications.
@@ -83,9 +288,77 @@ class ClusterNode(service.Service, KeyStoreMixin, LeaderElectionMixin):
         """The gossiper reports that C{peer} is dead."""
         self.election.peer_alive(peer)
 
+    def _gc_peers(self):
+        """Return the peers that have to observe a deletion before it
+        can be collected: all live peers, and the dead peers that
+        have been dead for less than C{gc_grace} seconds.
+        """
+        now = self.clock.seconds()
+        peers = self.gossiper.live_peers
+        for peer in peers:
+            self._dead_since.pop(peer.name, None)
+        for peer in self.gossiper.dead_peers:
+            dead_since = self._dead_since.setdefault(peer.name, now)
+            if now - dead_since <= self.gc_grace:
+                peers.append(peer)
+        return peers
+
+    def _observed_by_peers(self, peers, key, timestamp):
+        """Return C{True} if all C{peers} have observed the value of
+        C{key} written at C{timestamp}.
+        """
+        for peer in peers:
+            value = peer.get(key)
+            if value is None or value[0] < timestamp:
+                return False
+        return True
+
+    def collect_tombstones(self):
+        """Advance the garbage collection horizon.
+
+        Only the leader does this.  The horizon is moved up to the
+        newest tombstone for which it holds that it, and all older
+        tombstones, have been observed by every peer returned by
+        L{_gc_peers}.
+
+        All nodes prune their record of collected keys.
+        """
+        self.keystore.prune_collected()
+        if not self.election.is_leader:
+            return
+        peers = self._gc_peers()
+        observed, pending = [], []
+        for key, timestamp in self.keystore.tombstones():
+            if self._observed_by_peers(peers, key, timestamp):
+                observed.append(timestamp)
+            else:
+                pending.append(timestamp)
+        if pending:
+            oldest_pending = min(pending)
+            observed = [timestamp for timestamp in observed
+                        if timestamp < oldest_pending]
+        if observed and max(observed) > self.keystore.horizon:
+            self.keystore.set(self.HORIZON_KEY, max(observed))
+
+    def gc_stats(self):
+        """Return garbage collection statistics."""
+        return {'horizon': self.keystore.horizon,
+                'reclaimed': self.keystore.reclaimed,
+                'tombstones': len(self.keystore.tombstones()),
+                'collected': len(self.keystore.collected)}
+
+    def _collect_garbage(self, horizon):
+        """Purge tombstones behind C{horizon} from the keystore."""
+        reclaimed = self.keystore.collect_garbage(horizon)
+        if reclaimed:
+            stats = self.gc_stats()
+            log.msg(format='reclaimed %(reclaimed_now)d tombstones '
+                    '(%(reclaimed)d in total, %(tombstones)d remaining)',
+                    reclaimed_now=reclaimed, **stats)
+
     def leader_elected(self, is_leader):
         """Leader elected."""
-        print "is leader?", is_leader
+        log.msg('leader elected, is leader: %s' % (is_leader,))
         if is_leader:
             # Go through and possible trigger all notifications.
             for key in self.keystore.keys('app:*'):
@@ -95,24 +368,36 @@ class ClusterNode(service.Service, KeyStoreMixin, LeaderElectionMixin):
 
     def _notify(self, wkey, watcher):
         """Notification watcher about change."""
+        trace = self.tracer.trace('notify', watcher=watcher['name'],
+                                  endpoint=watcher['endpoint'])
         def done(result):
+            trace.finish(status='delivered')
             watcher['last-hit'] = self.clock.seconds()
             # Verify that the watcher has not been deleted.
-            if wkey in self and self.keystore[wkey] is not None:
+            if self.keystore.get(wkey) is not None:
                 self.keystore.set(wkey, watcher)
+        def failed(reason):
+            trace.finish(status='failed')
+            return reason
         d = self.client.getPage(str(watcher['endpoint']), method='POST',
                 postdata=json.dumps({'name': watcher['name'],
                                      'uri': watcher['uri']}),
                 timeout=3)
-        return d.addCallback(done).addErrback(log.err)
+        return d.addCallbacks(done, failed).addErrback(log.err)
 
     def _check_notify(self, key):
         """Possible notify listener that something has changed."""
-        for wkey in self.keystore.keys('watcher:*'):
-            watcher = self.keystore.get(wkey)
-            if watcher is None:
-                continue
-            timestamp = self.keystore.timestamp_for_key(key)
-            if (key.startswith(watcher['pattern'])
-                    and watcher['last-hit'] < timestamp):
-                self._notify(wkey, watcher)
+        trace = self.tracer.trace('check-notify', key=key)
+        notified = 0
+        try:
+            for wkey in self.keystore.keys('watcher:*'):
+                watcher = self.keystore.get(wkey)
+                if watcher is None:
+                    continue
+                timestamp = self.keystore.timestamp_for_key(key)
+                if (key.startswith(watcher['pattern'])
+                        and watcher['last-hit'] < timestamp):
+                    self._notify(wkey, watcher)
+                    notified += 1
+        finally:
+            trace.finish(notified=notified)
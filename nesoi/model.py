@@ -12,12 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import itertools
+import operator
+import random
+from collections import OrderedDict
+
+
+# Proximity ranks of a host relative to a requester.
+SAME_ZONE, SAME_REGION, ELSEWHERE = range(3)
+
+
 class ResourceModel(object):
-    """Data model for the resources."""
+    """Data model for the resources.
+
+    To answer locality queries quickly the model keeps, per service,
+    the zone and region of each host and lists of host names sorted
+    by proximity to each zone and region that has been asked about.
+    These are built when first needed and then kept up to date by
+    L{key_changed}.  At most C{max_nearby_lists} sorted lists are
+    kept per service; the least recently used is dropped first.
+    """
+
+    max_nearby_lists = 64
 
     def __init__(self, clock, keystore):
         self.clock = clock
         self.keystore = keystore
+        self._topology = {}
+        self._zones = {}
+        self._regions = {}
+        self._nearby = {}
 
     def apps(self):
         """Return a list of all applicaitons in the model."""
@@ -70,6 +95,12 @@ class ResourceModel(object):
             if not required in config:
                 raise ValueError('missing field "%s" in config' % (
                         required,))
+        for optional in ('zone', 'region'):
+            if optional in config and not (
+                    isinstance(config[optional], basestring)
+                    and config[optional]):
+                raise ValueError('field "%s" must be a non-empty string' % (
+                        optional,))
         config['updated_at'] = self.clock.seconds()
         self.keystore.set(key, config)
 
@@ -80,6 +111,143 @@ class ResourceModel(object):
             raise ValueError('no such host: %s/%s' % (srvname, hostname))
         self.keystore.set(key, None)
 
+    def _locality(self, config):
+        return config.get('zone'), config.get('region')
+
+    def _proximity(self, locality, zone, region):
+        host_zone, host_region = locality
+        if zone is not None and host_zone == zone:
+            return SAME_ZONE
+        if region is not None and host_region == region:
+            return SAME_REGION
+        return ELSEWHERE
+
+    def _service_topology(self, srvname):
+        """Return a mapping of host names to C{(zone, region)} pairs
+        for service C{srvname}.
+
+        Services without hosts are not cached.
+        """
+        topology = self._topology.get(srvname)
+        if topology is None:
+            topology = self._topology[srvname] = {}
+            self._zones[srvname] = {}
+            self._regions[srvname] = {}
+            for key in self.keystore.keys('srv:%s:*' % (srvname,)):
+                config = self.keystore.get(key)
+                if config is not None:
+                    locality = self._locality(config)
+                    topology[key.split(':', 2)[2]] = locality
+                    self._count_locality(srvname, locality, 1)
+            if not topology:
+                self._forget_service(srvname)
+        return topology
+
+    def _forget_service(self, srvname):
+        """Drop cached locality information about service
+        C{srvname}.
+        """
+        for cache in (self._topology, self._zones, self._regions,
+                      self._nearby):
+            cache.pop(srvname, None)
+
+    def _count_locality(self, srvname, locality, delta):
+        """Update the number of hosts of service C{srvname} in the
+        zone and region of C{locality} by C{delta}.
+        """
+        zone, region = locality
+        for counts, name in ((self._zones[srvname], zone),
+                             (self._regions[srvname], region)):
+            if name is None:
+                continue
+            counts[name] = counts.get(name, 0) + delta
+            if not counts[name]:
+                del counts[name]
+
+    def nearby_hosts(self, srvname, zone=None, region=None, scope=None):
+        """Return names of all available hosts for service C{srvname}
+        ordered by proximity to C{zone} and C{region}.
+
+        Hosts in the same zone come first, then hosts in the same
+        region, then the rest.  Hosts that are equally close are
+        returned in random order, so that clients spread out over
+        them.  If C{scope} is C{'zone'} or C{'region'} only hosts in
+        the same zone or region are returned.
+        """
+        if scope not in (None, 'zone', 'region'):
+            raise ValueError('scope must be "zone" or "region"')
+        if scope == 'zone' and zone is None:
+            raise ValueError('scope "zone" requires a zone')
+        if scope == 'region' and region is None:
+            raise ValueError('scope "region" requires a region')
+        topology = self._service_topology(srvname)
+        if not topology:
+            return []
+        # A zone or region that no host is in ranks all hosts the same
+        # as not giving one at all.
+        if zone not in self._zones[srvname]:
+            zone = None
+        if region not in self._regions[srvname]:
+            region = None
+        if ((scope == 'zone' and zone is None)
+                or (scope == 'region' and region is None)):
+            return []
+        nearby = self._nearby.setdefault(srvname, OrderedDict())
+        # Re-insert the list to keep the lists in LRU order.
+        ranked = nearby.pop((zone, region), None)
+        if ranked is None:
+            ranked = sorted(
+                (self._proximity(locality, zone, region), hostname)
+                for hostname, locality in topology.iteritems())
+            if len(nearby) >= self.max_nearby_lists:
+                nearby.popitem(last=False)
+        nearby[(zone, region)] = ranked
+        end = len(ranked)
+        if scope == 'zone':
+            end = bisect.bisect_left(ranked, (SAME_REGION,))
+        elif scope == 'region':
+            end = bisect.bisect_left(ranked, (ELSEWHERE,))
+        # The cached list is sorted so that it can be updated and
+        # sliced with bisect; shuffle each group when handing it out.
+        hosts = []
+        for proximity, group in itertools.groupby(ranked[:end],
+                                                  operator.itemgetter(0)):
+            group = [hostname for proximity, hostname in group]
+            random.shuffle(group)
+            hosts.extend(group)
+        return hosts
+
+    def key_changed(self, key, value):
+        """Update locality information after a change of C{key}."""
+        if not key.startswith('srv:'):
+            return
+        srvname, hostname = key.split(':', 2)[1:]
+        topology = self._topology.get(srvname)
+        if topology is None:
+            # Nobody has asked about this service yet.
+            return
+        old = topology.pop(hostname, None)
+        new = None
+        if value is not None:
+            new = topology[hostname] = self._locality(value)
+        if old == new:
+            return
+        if not topology:
+            # The last host is gone.
+            self._forget_service(srvname)
+            return
+        if old is not None:
+            self._count_locality(srvname, old, -1)
+        if new is not None:
+            self._count_locality(srvname, new, 1)
+        for (zone, region), ranked in self._nearby.get(srvname, {}).items():
+            if old is not None:
+                entry = (self._proximity(old, zone, region), hostname)
+                del ranked[bisect.bisect_left(ranked, entry)]
+            if new is not None:
+                bisect.insort(ranked,
+                              (self._proximity(new, zone, region), hostname))
+
     def services(self):
         """Return an iterable that will yield the name of all
         available services.
@@ -3,13 +3,25 @@ from twisted.web import server, http, client, error
 from twisted.internet import defer
 from twisted.python import log
 from zope.interface import Interface, implements
+from collections import OrderedDict
+import heapq
+import math
 import re
+
+from nesoi.trace import Tracer
 try:
     import json
 except ImportError:
     import simplejson as json
 
 
+TOO_MANY_REQUESTS = 429
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
 class ControllerError(Exception):
 
     def __init__(self, responseCode):
@@ -36,13 +48,17 @@ def read_json(request):
     return json.loads(request.content.read())
 
 
+def encode_json(data):
+    return json.dumps(data, indent=2).encode('utf-8')
+
+
 def write_json(request, data, ct='application/json', rc=200):
     """
     Write JSON reponse to request.
     """
-    sdata = json.dumps(data, indent=2).encode('utf-8')
+    sdata = encode_json(data)
     request.setHeader('content-type', ct)
-    request.setHeader('content-length', len(sdata))
+    request.setHeader('content-length', str(len(sdata)))
     request.setResponseCode(rc)
     request.write(sdata)
 
@@ -67,18 +83,120 @@ def compile_regexp(url_def):
     return '/'.join(l) + '$'
 
 
+class TokenBucket(object):
+    """
+    Token bucket that refills at C{rate} tokens per second and holds
+    at most C{burst} tokens.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, now):
+        """
+        Take a token from the bucket.
+
+        Return C{0} if a token was available, otherwise the number of
+        seconds until there will be one.
+        """
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+    """
+    Per-client rate limiter.
+
+    Clients are identified by their address.  Each client gets a
+    L{TokenBucket} allowing C{rate} requests per second with bursts
+    of up to C{burst} requests.  At most C{maxClients} buckets are
+    kept; the least recently seen client is forgotten first.
+    """
+
+    def __init__(self, clock, rate, burst, maxClients=10000):
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.maxClients = maxClients
+        self.buckets = OrderedDict()
+
+    def clientKey(self, request):
+        return request.getClientIP()
+
+    def check(self, request):
+        """
+        Charge C{request} to its client.
+
+        Return C{0} if the request may proceed, otherwise the number of
+        seconds the client has to wait before retrying.
+        """
+        now = self.clock.seconds()
+        key = self.clientKey(request)
+        # Re-insert the bucket to keep the buckets in LRU order.
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            if len(self.buckets) >= self.maxClients:
+                self.buckets.popitem(last=False)
+            bucket = TokenBucket(self.rate, self.burst, now)
+        self.buckets[key] = bucket
+        return bucket.consume(now)
+
+
 class Router(Resource):
+    """
+    Resource that dispatches requests to controllers.
+
+    Requests are not handled right away but put in a priority queue
+    that is drained at most C{batchSize} requests per reactor
+    iteration.  When the reactor is saturated, requests for
+    controllers added with a higher priority are thus served before
+    requests for controllers with a lower priority.  The priority of
+    a controller may also be given per method, as a C{dict} that maps
+    lower-case method names to priorities; methods not in the
+    C{dict} get C{PRIORITY_NORMAL}.
+
+    Each priority level adds C{agingDelay} seconds to the time a
+    request is ordered by, so a lower priority request that has
+    waited long enough is served before newer high priority
+    requests.  The queue holds at most C{maxQueue} requests; lower
+    priorities are turned away with a 503 earlier than higher ones.
+
+    Each request is traced using C{tracer}, with spans for routing,
+    queueing, decoding, the controller call, encoding and writing.
+    """
     isLeaf = True
 
-    def __init__(self):
+    def __init__(self, clock, rateLimiter=None, batchSize=10, tracer=None,
+                 maxQueue=1000, agingDelay=1):
         self.controllers = list()
-
-    def addController(self, controllerPath, controller):
+        self.clock = clock
+        self.tracer = tracer or Tracer(clock)
+        self.rateLimiter = rateLimiter
+        self.batchSize = batchSize
+        self.maxQueue = maxQueue
+        self.agingDelay = agingDelay
+        self.queue = []
+        self.sequence = 0
+        self.drainCall = None
+
+    def addController(self, controllerPath, controller,
+                      priority=PRIORITY_NORMAL):
         """
         Add router.
         """
         regexp = re.compile(compile_regexp(controllerPath))
-        self.controllers.append((regexp, controller))
+        self.controllers.append((regexp, controller, priority))
 
     def getController(self, request):
         """
@@ -90,14 +208,17 @@ class Router(Resource):
             if not postpath[-1]:
                 del postpath[-1]
         p = '/'.join(postpath)
-        for regexp, controller in self.controllers:
+        for regexp, controller, priority in self.controllers:
             m = regexp.match(p)
             if m is not None:
-                return controller, controllerUrl.click(p), m.groupdict()
-        print "no matching controller", p
+                return (controller, controllerUrl.click(p), m.groupdict(),
+                        priority)
+        log.msg('no matching controller for %r' % (p,))
+        return None, None, None, None
 
     def ebControl(self, reason, request):
-        reason.printTraceback()
+        # Controller errors are expected; anything else is passed on
+        # to ebInternal and logged with its traceback.
         reason.trap(ControllerError)
         request.setResponseCode(reason.value.responseCode)
         if reason.value.message is not None:
@@ -106,11 +227,13 @@ class Router(Resource):
         else:
             request.setHeader('content-length', '0')
         request.finish()
+        request.trace.finish(status=reason.value.responseCode)
 
     def ebInternal(self, reason, request):
         request.setResponseCode(http.INTERNAL_SERVER_ERROR)
         request.setHeader('content-length', '0')
         request.finish()
+        request.trace.finish(status=http.INTERNAL_SERVER_ERROR)
         return reason
 
     def cbControl(self, result, request):
@@ -126,37 +249,124 @@ class Router(Resource):
         elif type(result) == int:
             rc = result
 
+        span = request.trace.span('encode')
         if type(result) == dict:
-            write_json(request, result, rc=rc)
-        elif type(result) == str:
+            result = encode_json(result)
+            request.setHeader('content-type', 'application/json')
+            request.setHeader('content-length', str(len(result)))
+        span.finish()
+
+        span = request.trace.span('write')
+        if type(result) == str:
             request.setResponseCode(rc)
             request.write(result)
         else:
-            request.setHeader('content-length', 0)
+            request.setHeader('content-length', '0')
 
         request.finish()
+        span.finish()
+        request.trace.finish(status=rc)
 
     def render(self, request):
         """
         Render request.
         """
-        controller, url, params = self.getController(request)
+        trace = request.trace = self.tracer.trace(
+            '%s %s' % (request.method, request.path))
+        if self.rateLimiter is not None:
+            delay = self.rateLimiter.check(request)
+            if delay:
+                request.setResponseCode(TOO_MANY_REQUESTS)
+                request.setHeader('retry-after',
+                                  str(int(math.ceil(delay))))
+                request.setHeader('content-length', '0')
+                trace.finish(status=TOO_MANY_REQUESTS)
+                return ''
+
+        span = trace.span('route')
+        controller, url, params, priority = self.getController(request)
+        span.finish()
         if controller is None:
             request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+            trace.finish(status=http.INTERNAL_SERVER_ERROR)
             return 'No controller found for URL'
 
         method = getattr(controller, request.method.lower(), None)
         if method is None:
             request.setResponseCode(http.NOT_ALLOWED)
+            trace.finish(status=http.NOT_ALLOWED)
             return ''
+        if isinstance(priority, dict):
+            priority = priority.get(request.method.lower(), PRIORITY_NORMAL)
+
+        # Leave room in the queue for higher priorities.
+        levels = PRIORITY_LOW + 1
+        if len(self.queue) >= self.maxQueue * (levels - priority) / levels:
+            request.setResponseCode(http.SERVICE_UNAVAILABLE)
+            request.setHeader('retry-after', '1')
+            request.setHeader('content-length', '0')
+            trace.finish(status=http.SERVICE_UNAVAILABLE)
+            return ''
+
+        self.enqueue(priority, request, method, url, params)
+        return server.NOT_DONE_YET
+
+    def enqueue(self, priority, request, method, url, params):
+        """
+        Queue a request for dispatching to its controller.
+        """
+        request.notifyFinish().addErrback(self.ebDisconnected, request)
+        # The sequence number keeps requests with the same deadline
+        # in arrival order.
+        self.sequence += 1
+        request.queueSpan = request.trace.span('queue')
+        deadline = self.clock.seconds() + priority * self.agingDelay
+        heapq.heappush(self.queue, (deadline, self.sequence, request,
+                                    method, url, params))
+        if self.drainCall is None:
+            self.drainCall = self.clock.callLater(0, self.drain)
+
+    def ebDisconnected(self, reason, request):
+        request.disconnected = True
+
+    def drain(self):
+        """
+        Dispatch up to C{batchSize} queued requests.
+        """
+        self.drainCall = None
+        for i in range(min(self.batchSize, len(self.queue))):
+            deadline, sequence, request, method, url, params = (
+                heapq.heappop(self.queue))
+            request.queueSpan.finish()
+            if getattr(request, 'disconnected', False):
+                request.trace.finish(disconnected=True)
+                continue
+            self.dispatch(request, method, url, params)
+        if self.queue:
+            self.drainCall = self.clock.callLater(0, self.drain)
+
+    def callController(self, request, method, url, params):
+        """
+        Decode the request body, if any, and call controller
+        C{method}.
+        """
+        span = request.trace.span('decode')
         input = []
         if request.method.lower() in ('post', 'put'):
             input.append(read_json(request))
+        span.finish()
+
+        span = request.trace.span('model')
+        return defer.maybeDeferred(method, self, request, url,
+                                   *input, **params).addBoth(span.finish)
 
-        doneDeferred = defer.maybeDeferred(method, self, request, url,
-                                           *input, **params)
+    def dispatch(self, request, method, url, params):
+        """
+        Call controller C{method} for C{request}.
+        """
+        doneDeferred = defer.maybeDeferred(self.callController, request,
+                                           method, url, params)
         doneDeferred.addCallback(self.cbControl, request)
         doneDeferred.addErrback(self.ebControl, request)
         doneDeferred.addErrback(self.ebInternal, request)
         doneDeferred.addErrback(log.deferr)
-        return server.NOT_DONE_YET
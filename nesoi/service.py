@@ -17,10 +17,11 @@ import shelve
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPServer, UDPServer
 from twisted.web.server import Site
-from txgossip.gossip import Gossiper
 
 from nesoi.model import ResourceModel
 from nesoi.keystore import ClusterNode
+from nesoi.gossip import Gossiper
+from nesoi.trace import Profiler, Tracer
 from nesoi import api, rest
 
 
@@ -32,29 +33,66 @@ def create_service(reactor, options):
 
     listen_address = options['listen-address']
 
+    gossip_interval = float(options['gossip-interval'])
+
+    slow_threshold = float(options['slow-threshold']) or None
+    tracer = Tracer(reactor, slow_threshold=slow_threshold)
+
     storage = shelve.open(options['data-file'], writeback=True)
-    cluster_node = ClusterNode(reactor, storage)
+    cluster_node = ClusterNode(reactor, storage,
+                               sync_interval=gossip_interval,
+                               gc_interval=float(options['gc-interval']),
+                               gc_grace=float(options['gc-grace']),
+                               tracer=tracer)
     service.addService(cluster_node)
 
     model = ResourceModel(reactor, cluster_node.keystore)
+    cluster_node.keystore.add_observer(model.key_changed)
 
-    gossiper = Gossiper(reactor, cluster_node, listen_address)
+    gossiper = Gossiper(reactor, cluster_node, listen_address,
+                        interval=gossip_interval,
+                        fanout=int(options['gossip-fanout']),
+                        max_packet_size=int(options['gossip-packet-size']))
     if options['seed']:
         gossiper.seed([options['seed']])
 
     service.addService(UDPServer(int(options['listen-port']), gossiper,
         interface=listen_address))
 
-    router = rest.Router()
-    router.addController('app', api.ApplicationCollectionResource(model))
-    router.addController('app/{appname}/web-hooks', api.WebhookCollectionResource(model, 'appname', 'app'))
-    router.addController('app/{appname}/web-hooks/{hookname}', api.WebhookResource(model, 'appname', 'app'))
-    router.addController('app/{appname}', api.ApplicationResource(model))
-    router.addController('srv', api.ServiceCollectionResource(model))
-    router.addController('srv/{srvname}', api.ServiceHostCollectionResource(model))
-    router.addController('srv/{srvname}/web-hooks', api.WebhookCollectionResource(model, 'srvname', 'service'))
-    router.addController('srv/{srvname}/web-hooks/{hookname}', api.WebhookResource(model, 'srvname', 'service'))
-    router.addController('srv/{srvname}/{hostname}', api.ServiceHostResource(model))
+    rate_limiter = None
+    if float(options['rate-limit']):
+        rate_limiter = rest.RateLimiter(reactor, float(options['rate-limit']),
+                                        int(options['rate-burst']))
+
+    # Changes are served before reads; listing a collection is the
+    # most expensive read.
+    resource = dict.fromkeys(('put', 'post', 'delete'), rest.PRIORITY_HIGH)
+    collection = dict(resource, get=rest.PRIORITY_LOW)
+
+    router = rest.Router(reactor, rate_limiter, tracer=tracer)
+    router.addController('app', api.ApplicationCollectionResource(model),
+                         priority=collection)
+    router.addController('app/{appname}/web-hooks', api.WebhookCollectionResource(model, 'appname', 'app'),
+                         priority=collection)
+    router.addController('app/{appname}/web-hooks/{hookname}', api.WebhookResource(model, 'appname', 'app'),
+                         priority=resource)
+    router.addController('app/{appname}', api.ApplicationResource(model),
+                         priority=resource)
+    router.addController('srv', api.ServiceCollectionResource(model),
+                         priority=collection)
+    router.addController('srv/{srvname}', api.ServiceHostCollectionResource(model),
+                         priority=collection)
+    router.addController('srv/{srvname}/web-hooks', api.WebhookCollectionResource(model, 'srvname', 'service'),
+                         priority=collection)
+    router.addController('srv/{srvname}/web-hooks/{hookname}', api.WebhookResource(model, 'srvname', 'service'),
+                         priority=resource)
+    router.addController('srv/{srvname}/{hostname}', api.ServiceHostResource(model),
+                         priority=resource)
+    if options['debug']:
+        router.addController('_debug/profile',
+                             api.ProfileResource(Profiler(reactor)))
+        router.addController('_debug/gc',
+                             api.GarbageCollectionResource(cluster_node))
 
     service.addService(TCPServer(int(options['listen-port']), Site(router),
         interface=listen_address))
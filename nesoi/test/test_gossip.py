@@ -0,0 +1,189 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import random
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+
+from nesoi.gossip import Gossiper
+
+
+class FakeNetwork(object):
+    """Delivers datagrams between gossipers through a clock."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.gossipers = {}
+
+    def deliver(self, data, source, destination):
+        gossiper = self.gossipers.get(destination)
+        if gossiper is not None:
+            self.clock.callLater(0, gossiper.datagramReceived, data, source)
+
+
+class FakeTransport(object):
+
+    def __init__(self, network, host, port):
+        self.network = network
+        self.host = host
+        self.port = port
+
+    def getHost(self):
+        return IPv4Address('UDP', self.host, self.port)
+
+    def write(self, data, address):
+        self.network.deliver(data, (self.host, self.port), address)
+
+
+class Participant(object):
+    """Participant that keeps track of dead peers."""
+
+    def __init__(self):
+        self.dead = []
+
+    def make_connection(self, gossiper):
+        self.gossiper = gossiper
+
+    def value_changed(self, peer, key, value):
+        pass
+
+    def peer_alive(self, peer):
+        pass
+
+    def peer_dead(self, peer):
+        self.dead.append(peer.name)
+
+
+class ConvergenceTestCase(unittest.TestCase):
+    """Convergence of a cluster of gossipers on a simulated network."""
+
+    def setUp(self):
+        random.seed(0)
+        self.clock = task.Clock()
+        self.network = FakeNetwork(self.clock)
+
+    def start_cluster(self, size, **kwargs):
+        gossipers = []
+        for port in range(7000, 7000 + size):
+            participant = Participant()
+            gossiper = Gossiper(self.clock, participant, '127.0.0.1',
+                                **kwargs)
+            if gossipers:
+                gossiper.seed(['127.0.0.1:7000'])
+            self.network.gossipers[('127.0.0.1', port)] = gossiper
+            gossiper.makeConnection(
+                FakeTransport(self.network, '127.0.0.1', port))
+            # Something the size of a host record.
+            gossiper.set('srv:test:%d' % (port,), [0, {
+                'endpoints': {'http': 'http://127.0.0.1:%d/' % (port,)},
+                'zone': 'zone-a', 'region': 'region-a',
+                'updated_at': 0}])
+            gossipers.append(gossiper)
+        self.addCleanup(self.stop_cluster, gossipers)
+        return gossipers
+
+    def stop_cluster(self, gossipers):
+        for gossiper in gossipers:
+            gossiper.stopProtocol()
+
+    def converged(self, gossipers):
+        for gossiper in gossipers:
+            if len(gossiper.live_peers) != len(gossipers) - 1:
+                return False
+            for other in gossipers:
+                key = 'srv:test:%s' % (other.name.split(':')[1],)
+                state = gossiper._states.get(other.name)
+                if state is None or key not in state:
+                    return False
+        return True
+
+    def rounds_to_converge(self, gossipers, limit=60):
+        for rounds in range(1, limit + 1):
+            self.clock.advance(1)
+            if self.converged(gossipers):
+                return rounds
+        self.fail('cluster did not converge in %d rounds' % (limit,))
+
+    def test_fifty_nodes_converge(self):
+        gossipers = self.start_cluster(50)
+        self.assertTrue(self.rounds_to_converge(gossipers) <= 20)
+
+    def test_fanout_speeds_up_convergence(self):
+        slow = self.rounds_to_converge(self.start_cluster(50, fanout=1))
+        self.setUp()
+        fast = self.rounds_to_converge(self.start_cluster(50, fanout=3))
+        self.assertTrue(fast < slow, (fast, slow))
+
+    def test_small_packets_do_not_starve_peers(self):
+        gossipers = self.start_cluster(50)
+        self.rounds_to_converge(gossipers)
+        for gossiper in gossipers:
+            del gossiper.participant.dead[:]
+        worst = 0
+        for second in range(60):
+            self.clock.advance(1)
+            for gossiper in gossipers:
+                for other in gossipers:
+                    if other is not gossiper:
+                        seen = gossiper._states[other.name].get(
+                            '__heartbeat__', 0)
+                        worst = max(worst,
+                            other.state.heart_beat_version - seen)
+        for gossiper in gossipers:
+            self.assertEquals(gossiper.participant.dead, [])
+        # Heartbeats keep flowing well within what the failure
+        # detector tolerates.
+        self.assertTrue(worst < 15, worst)
+
+    def test_pack_respects_packet_size(self):
+        gossiper = Gossiper(self.clock, Participant(), max_packet_size=200)
+        # Grouped by peer, like Scuttle.scuttle produces them.
+        deltas = [('peer%d' % (i // 10,), 'k%d' % (i,), [0, 'x' * 20], i)
+                  for i in range(30)]
+        data = gossiper._pack({'type': 'first-response'}, deltas)
+        updates = json.loads(data)['updates']
+        self.assertTrue(len(data) <= 200)
+        # Every peer got a share, and each a prefix of its deltas.
+        for peer in ('peer0', 'peer1', 'peer2'):
+            versions = [version for (name, key, value, version) in updates
+                        if name == peer]
+            self.assertNotEquals(versions, [])
+            self.assertEquals(versions, [version for (name, key, value,
+                    version) in deltas if name == peer][:len(versions)])
+
+    def test_request_digest_respects_packet_size(self):
+        gossiper = Gossiper(self.clock, Participant(), max_packet_size=200)
+        gossiper.name = '127.0.0.1:7000'
+        digest = dict(('127.0.0.1:%d' % (port,), port)
+                      for port in range(7000, 7100))
+        data = gossiper._pack_digest({'type': 'request'}, digest)
+        packed = json.loads(data)['digest']
+        self.assertTrue(len(data) <= 200)
+        self.assertIn('127.0.0.1:7000', packed)
+        self.assertTrue(1 < len(packed) < 100)
+        for name, version in packed.items():
+            self.assertEquals(digest[name], version)
+
+    def test_hundred_nodes_converge_with_default_packet_size(self):
+        gossipers = self.start_cluster(100)
+        self.rounds_to_converge(gossipers)
+
+    def test_pack_always_sends_one_delta(self):
+        gossiper = Gossiper(self.clock, Participant(), max_packet_size=10)
+        data = gossiper._pack({'type': 'first-response'},
+                              [('peer', 'k', [0, 'x' * 20], 1)])
+        self.assertEquals(len(json.loads(data)['updates']), 1)
@@ -0,0 +1,265 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+from twisted.python import log
+from txgossip.state import PeerState
+
+from nesoi.gossip import Gossiper
+from nesoi.keystore import ClusterNode, _KeyStore
+from nesoi.model import ResourceModel
+from nesoi.trace import Tracer
+
+
+class KeyStoreParticipant(object):
+
+    def __init__(self):
+        self.keystore = None
+
+    def value_changed(self, peer, key, value):
+        if key != '__heartbeat__':
+            self.keystore.value_changed(peer, key, value)
+
+
+class KeyStoreGarbageCollectionTestCase(unittest.TestCase):
+    """Test cases for garbage collection of tombstones."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.storage = {}
+        participant = KeyStoreParticipant()
+        self.gossiper = Gossiper(self.clock, participant)
+        self.gossiper.name = 'self'
+        self.gossiper.state.set_name('self')
+        self.keystore = _KeyStore(self.clock, self.storage)
+        participant.keystore = self.keystore
+        self.keystore.make_connection(self.gossiper)
+        self.peer = PeerState(self.clock, participant, name='peer')
+        self.gossiper._states['peer'] = self.peer
+
+    def replicate(self, key, timestamped_value):
+        self.peer.update_with_delta(key, timestamped_value,
+                                    self.peer.max_version_seen + 1)
+
+    def test_collect_removes_tombstones_behind_horizon(self):
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.gossiper.set('srv:a:h2', [3, None])
+        self.gossiper.set('srv:a:h3', [1, {'endpoints': {}}])
+        self.assertEquals(self.keystore.collect_garbage(2), 1)
+        self.assertNotIn('srv:a:h1', self.keystore)
+        self.assertNotIn('srv:a:h1', self.storage)
+        self.assertEquals(self.keystore.tombstones(), [('srv:a:h2', 3)])
+        self.assertEquals(self.keystore.get('srv:a:h3'), {'endpoints': {}})
+        self.assertEquals(self.keystore.reclaimed, 1)
+
+    def test_old_value_of_collected_key_is_not_replicated(self):
+        self.gossiper.set('srv:a:h1', [2, None])
+        self.keystore.collect_garbage(2)
+        self.replicate('srv:a:h1', [1, {'endpoints': {}}])
+        self.assertNotIn('srv:a:h1', self.keystore)
+
+    def test_new_value_of_collected_key_is_replicated(self):
+        self.gossiper.set('srv:a:h1', [2, None])
+        self.keystore.collect_garbage(2)
+        self.replicate('srv:a:h1', [3, {'endpoints': {}}])
+        self.assertEquals(self.keystore.get('srv:a:h1'), {'endpoints': {}})
+        self.assertNotIn('srv:a:h1', self.keystore.collected)
+
+    def test_unknown_key_behind_horizon_is_replicated(self):
+        self.keystore.collect_garbage(5)
+        self.replicate('srv:a:h1', [1, {'endpoints': {}}])
+        self.assertEquals(self.keystore.get('srv:a:h1'), {'endpoints': {}})
+
+    def test_unknown_tombstone_behind_horizon_is_not_replicated(self):
+        self.keystore.collect_garbage(5)
+        self.replicate('srv:a:h1', [1, None])
+        self.assertNotIn('srv:a:h1', self.keystore)
+
+    def test_collected_keys_are_persisted(self):
+        self.gossiper.set('srv:a:h1', [2, None])
+        self.keystore.collect_garbage(2)
+        keystore = _KeyStore(self.clock, self.storage)
+        self.assertEquals(keystore.collected, {'srv:a:h1': 2})
+        keystore.make_connection(Gossiper(self.clock, KeyStoreParticipant()))
+        keystore.load_from(self.storage)
+        self.assertNotIn(_KeyStore.COLLECTED_KEY, keystore)
+
+    def test_prune_waits_for_grace_period(self):
+        self.keystore.gc_grace = 10
+        self.gossiper.set('srv:a:h1', [2, None])
+        self.keystore.collect_garbage(2)
+        self.clock.advance(11)
+        self.assertEquals(self.keystore.prune_collected(), 0)
+        self.clock.advance(1)
+        self.assertEquals(self.keystore.prune_collected(), 1)
+        self.assertEquals(self.keystore.collected, {})
+        self.assertEquals(self.storage[_KeyStore.COLLECTED_KEY], {})
+
+    def test_prune_keeps_keys_peers_hold_older_values_of(self):
+        self.keystore.gc_grace = 10
+        self.peer.update_with_delta('srv:a:h1', [1, {'endpoints': {}}], 1)
+        self.gossiper.set('srv:a:h1', [2, None])
+        self.keystore.collect_garbage(2)
+        self.clock.advance(20)
+        self.assertEquals(self.keystore.prune_collected(), 0)
+        self.peer.update_with_delta('srv:a:h1', [2, None], 2)
+        self.assertEquals(self.keystore.prune_collected(), 1)
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.posted = []
+
+    def getPage(self, url, method=None, postdata=None, timeout=None):
+        self.posted.append((url, json.loads(postdata)))
+        return defer.succeed('')
+
+
+class ClusterNodeNotifyTestCase(unittest.TestCase):
+    """Test cases for web-hook notifications."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.client = FakeClient()
+        self.traces = []
+        tracer = Tracer(self.clock)
+        tracer.add_observer(self.traces.append)
+        self.node = ClusterNode(self.clock, {}, client=self.client,
+                                tracer=tracer)
+        self.gossiper = Gossiper(self.clock, self.node)
+        self.gossiper.name = 'self'
+        self.gossiper.state.set_name('self')
+        self.node.gossiper = self.gossiper
+        self.node.keystore.make_connection(self.gossiper)
+        self.model = ResourceModel(self.clock, self.node.keystore)
+
+    def test_watcher_is_notified_and_traced(self):
+        self.model.watch_service('dm', {'name': 'hook',
+                                        'endpoint': 'http://hook/'})
+        self.clock.advance(1)
+        self.model.set_host('dm', 'host1', {'endpoints': {}})
+        self.node._check_notify('srv:dm:host1')
+        self.assertEquals(self.client.posted, [
+            ('http://hook/', {'name': 'hook', 'uri': '/srv/dm'})])
+        self.assertEquals([(trace.name, trace.tags.get('status'),
+                            trace.tags.get('notified'))
+                           for trace in self.traces],
+                          [('notify', 'delivered', None),
+                           ('check-notify', None, 1)])
+
+
+class ClusterNodeGarbageCollectionTestCase(unittest.TestCase):
+    """Test cases for the garbage collection horizon."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.storage = {}
+        self.node = ClusterNode(self.clock, self.storage, gc_grace=10)
+        self.gossiper = Gossiper(self.clock, self.node)
+        self.gossiper.name = 'self'
+        self.gossiper.state.set_name('self')
+        self.node.gossiper = self.gossiper
+        self.node.keystore.make_connection(self.gossiper)
+        self.node.election.is_leader = True
+        self.keystore = self.node.keystore
+
+    def add_peer(self, name, alive=True):
+        peer = PeerState(self.clock, self.node, name=name)
+        peer.alive = alive
+        self.gossiper._states[name] = peer
+        return peer
+
+    def observe(self, peer, key, timestamped_value):
+        peer.update_with_delta(key, timestamped_value,
+                               peer.max_version_seen + 1)
+
+    def horizon(self):
+        return self.gossiper.get(ClusterNode.HORIZON_KEY)
+
+    def test_only_leader_advances_horizon(self):
+        self.node.election.is_leader = False
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.node.collect_tombstones()
+        self.assertEquals(self.horizon(), None)
+        self.assertEquals(self.keystore.tombstones(), [('srv:a:h1', 1)])
+
+    def test_horizon_stops_before_oldest_pending_tombstone(self):
+        peer = self.add_peer('peer')
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.gossiper.set('srv:a:h2', [2, None])
+        self.gossiper.set('srv:a:h3', [3, None])
+        self.observe(peer, 'srv:a:h1', [1, None])
+        self.observe(peer, 'srv:a:h3', [3, None])
+        self.node.collect_tombstones()
+        self.assertEquals(self.horizon()[1], 1)
+        self.assertEquals(self.keystore.horizon, 1)
+        self.assertEquals(self.keystore.tombstones(),
+                          [('srv:a:h2', 2), ('srv:a:h3', 3)])
+
+    def test_horizon_only_moves_forward(self):
+        self.keystore.horizon = 5
+        self.add_peer('peer')
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.observe(self.gossiper._states['peer'], 'srv:a:h1', [1, None])
+        self.node.collect_tombstones()
+        self.assertEquals(self.horizon(), None)
+
+    def test_dead_peer_holds_back_horizon_during_grace(self):
+        self.add_peer('peer', alive=False)
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.node.collect_tombstones()
+        self.assertEquals(self.horizon(), None)
+        self.clock.advance(11)
+        self.node.collect_tombstones()
+        self.assertEquals(self.horizon()[1], 1)
+        self.assertEquals(self.keystore.tombstones(), [])
+
+    def test_revived_peer_restarts_grace(self):
+        peer = self.add_peer('peer', alive=False)
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.node.collect_tombstones()
+        peer.alive = True
+        self.clock.advance(11)
+        self.node.collect_tombstones()
+        peer.alive = False
+        self.node.collect_tombstones()
+        self.assertEquals(self.horizon(), None)
+
+    def test_horizon_from_leader_collects_garbage(self):
+        leader = self.add_peer('leader')
+        self.node.election.is_leader = False
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.gossiper.set('srv:a:h2', [3, None])
+        self.observe(leader, ClusterNode.HORIZON_KEY, [4, 2])
+        self.assertEquals(self.keystore.horizon, 2)
+        self.assertEquals(self.keystore.tombstones(), [('srv:a:h2', 3)])
+        self.assertEquals(self.keystore.collected, {'srv:a:h1': 1})
+
+    def test_collection_is_logged(self):
+        events = []
+        log.addObserver(events.append)
+        self.addCleanup(log.removeObserver, events.append)
+        self.gossiper.set('srv:a:h1', [1, None])
+        self.gossiper.set('srv:a:h2', [3, None])
+        self.node._collect_garbage(2)
+        event, = [event for event in events if 'reclaimed_now' in event]
+        self.assertEquals((event['reclaimed_now'], event['reclaimed'],
+                           event['tombstones'], event['collected'],
+                           event['horizon']), (1, 1, 1, 1, 2))
+        self.assertEquals(self.node.gc_stats(), {
+            'horizon': 2, 'reclaimed': 1, 'tombstones': 1, 'collected': 1})
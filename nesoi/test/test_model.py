@@ -0,0 +1,129 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fnmatch
+
+from twisted.trial import unittest
+from twisted.internet import task
+
+from nesoi.model import ResourceModel
+
+
+class FakeKeyStore(dict):
+    """Dictionary with the parts of the keystore interface the model
+    uses.
+    """
+
+    def __init__(self):
+        self.observers = []
+
+    def keys(self, pattern=None):
+        return [key for key in dict.keys(self)
+                if pattern is None or fnmatch.fnmatch(key, pattern)]
+
+    def set(self, key, value):
+        self[key] = value
+        for observer in self.observers:
+            observer(key, value)
+
+
+class LocalityTestCase(unittest.TestCase):
+    """Test cases for locality-aware service discovery."""
+
+    def setUp(self):
+        self.keystore = FakeKeyStore()
+        self.model = ResourceModel(task.Clock(), self.keystore)
+        self.keystore.observers.append(self.model.key_changed)
+        self.set_host('h1', zone='z1', region='r1')
+        self.set_host('h2', zone='z2', region='r1')
+        self.set_host('h3', zone='z3', region='r2')
+
+    def set_host(self, hostname, **locality):
+        locality['endpoints'] = {}
+        self.model.set_host('srv', hostname, locality)
+
+    def test_hosts_ordered_by_proximity(self):
+        self.assertEquals(self.model.nearby_hosts('srv', 'z2', 'r1'),
+                          ['h2', 'h1', 'h3'])
+
+    def test_scope_filters_hosts(self):
+        self.assertEquals(
+            self.model.nearby_hosts('srv', 'z2', 'r1', 'zone'), ['h2'])
+        self.assertEquals(
+            self.model.nearby_hosts('srv', 'z2', 'r1', 'region'),
+            ['h2', 'h1'])
+
+    def test_lists_are_updated_on_host_changes(self):
+        self.model.nearby_hosts('srv', 'z2', 'r1')
+        self.set_host('h3', zone='z2', region='r1')
+        self.set_host('h4')
+        self.model.del_host('srv', 'h1')
+        hosts = self.model.nearby_hosts('srv', 'z2', 'r1')
+        self.assertEquals(sorted(hosts[:2]), ['h2', 'h3'])
+        self.assertEquals(hosts[2:], ['h4'])
+
+    def test_equally_close_hosts_are_shuffled(self):
+        self.set_host('h4', zone='z1', region='r1')
+        self.set_host('h5', zone='z1', region='r1')
+        self.set_host('h6', zone='z1', region='r1')
+        first = set()
+        for i in range(50):
+            hosts = self.model.nearby_hosts('srv', 'z1', 'r1')
+            self.assertEquals(sorted(hosts[:4]), ['h1', 'h4', 'h5', 'h6'])
+            self.assertEquals(hosts[4:], ['h2', 'h3'])
+            first.add(hosts[0])
+        self.assertTrue(len(first) > 1, first)
+
+    def test_unknown_service_is_not_cached(self):
+        self.assertEquals(self.model.nearby_hosts('junk', 'z1'), [])
+        for cache in (self.model._topology, self.model._zones,
+                      self.model._regions, self.model._nearby):
+            self.assertNotIn('junk', cache)
+
+    def test_service_is_forgotten_with_last_host(self):
+        self.model.nearby_hosts('srv', 'z1')
+        for hostname in ('h1', 'h2', 'h3'):
+            self.model.del_host('srv', hostname)
+        for cache in (self.model._topology, self.model._zones,
+                      self.model._regions, self.model._nearby):
+            self.assertNotIn('srv', cache)
+        self.set_host('h4', zone='z1')
+        self.assertEquals(self.model.nearby_hosts('srv', 'z1'), ['h4'])
+
+    def test_unknown_locality_shares_cached_list(self):
+        self.model.nearby_hosts('srv', 'junk1', 'junk1')
+        self.model.nearby_hosts('srv', 'junk2', 'r2')
+        self.assertEquals(list(self.model._nearby['srv']),
+                          [(None, None), (None, 'r2')])
+        self.assertEquals(
+            self.model.nearby_hosts('srv', 'junk', 'r1', 'zone'), [])
+
+    def test_least_recently_used_list_is_dropped(self):
+        self.model.max_nearby_lists = 2
+        self.model.nearby_hosts('srv', 'z1')
+        self.model.nearby_hosts('srv', 'z2')
+        self.model.nearby_hosts('srv', 'z1')
+        self.model.nearby_hosts('srv', 'z3')
+        self.assertEquals(list(self.model._nearby['srv']),
+                          [('z1', None), ('z3', None)])
+
+    def test_zone_of_last_host_is_forgotten(self):
+        self.model.nearby_hosts('srv', 'z3')
+        self.model.del_host('srv', 'h3')
+        self.assertEquals(
+            self.model.nearby_hosts('srv', 'z3', None, 'zone'), [])
+
+    def test_set_host_rejects_invalid_zone(self):
+        self.assertRaises(ValueError, self.set_host, 'h5', zone=3)
+        self.assertRaises(ValueError, self.set_host, 'h5', region='')
@@ -0,0 +1,171 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cStringIO import StringIO
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from twisted.python.urlpath import URLPath
+from twisted.web import http, server
+from twisted.web.test.requesthelper import DummyRequest
+
+from nesoi import rest
+from nesoi.trace import Tracer
+
+
+class Request(DummyRequest):
+
+    def __init__(self, path, ip='10.0.0.1', method='GET', **headers):
+        DummyRequest.__init__(self, path.split('/'))
+        self.method = method
+        self.client = IPv4Address('TCP', ip, 1234)
+        self.path = '/' + path
+        for name, value in headers.items():
+            self.requestHeaders.setRawHeaders(name, [value])
+
+    def URLPath(self):
+        return URLPath.fromString('http://localhost/')
+
+    def getClientIP(self):
+        return self.client.host
+
+
+class Controller(object):
+
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+
+    def get(self, router, request, url):
+        self.calls.append(self.name)
+        return {}
+
+    def put(self, router, request, url, data):
+        self.calls.append(data)
+        return {}
+
+    def delete(self, router, request, url):
+        self.calls.append('delete ' + self.name)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = rest.RateLimiter(self.clock, 1, 2, maxClients=2)
+
+    def test_limits_client_after_burst(self):
+        self.assertEquals(self.limiter.check(Request('srv')), 0)
+        self.assertEquals(self.limiter.check(Request('srv')), 0)
+        self.assertEquals(self.limiter.check(Request('srv')), 1)
+        self.clock.advance(1)
+        self.assertEquals(self.limiter.check(Request('srv')), 0)
+
+    def test_authorization_header_does_not_give_new_bucket(self):
+        for token in ('a', 'b', 'c'):
+            delay = self.limiter.check(Request('srv', authorization=token))
+        self.assertNotEquals(delay, 0)
+
+    def test_evicts_least_recently_seen_client(self):
+        for ip in ('10.0.0.1', '10.0.0.2', '10.0.0.1', '10.0.0.3'):
+            self.limiter.check(Request('srv', ip=ip))
+        self.assertEquals(list(self.limiter.buckets),
+                          ['10.0.0.1', '10.0.0.3'])
+
+
+class RouterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.calls = []
+        self.traces = []
+        tracer = Tracer(self.clock)
+        tracer.add_observer(self.traces.append)
+        self.router = rest.Router(self.clock, maxQueue=3, tracer=tracer)
+        self.router.addController('high', Controller('high', self.calls),
+                                  priority=rest.PRIORITY_HIGH)
+        self.router.addController('low', Controller('low', self.calls),
+                                  priority=rest.PRIORITY_LOW)
+
+    def render(self, path, **kwargs):
+        request = Request(path, **kwargs)
+        return request, self.router.render(request)
+
+    def test_rate_limited_request_gets_retry_after(self):
+        self.router.rateLimiter = rest.RateLimiter(self.clock, 0.5, 1)
+        self.render('low')
+        request, result = self.render('low')
+        self.assertEquals(request.responseCode, rest.TOO_MANY_REQUESTS)
+        self.assertEquals(request.responseHeaders.getRawHeaders(
+            'retry-after'), ['2'])
+
+    def test_high_priority_served_first(self):
+        self.render('low')
+        self.render('high')
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ['high', 'low'])
+
+    def test_priority_per_method(self):
+        self.router.addController('mixed', Controller('mixed', self.calls),
+                                  priority={'delete': rest.PRIORITY_HIGH,
+                                            'get': rest.PRIORITY_LOW})
+        self.render('mixed', method='GET')
+        self.render('high')
+        self.render('mixed', method='DELETE')
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ['high', 'delete mixed', 'mixed'])
+
+    def test_waiting_low_priority_request_is_aged(self):
+        self.render('low')
+        # Let time pass without draining the queue.
+        self.clock.rightNow += 3
+        self.render('high')
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ['low', 'high'])
+
+    def test_full_queue_sheds_low_priority_first(self):
+        request, result = self.render('low')
+        self.assertEquals(result, server.NOT_DONE_YET)
+        request, result = self.render('low')
+        self.assertEquals(request.responseCode, http.SERVICE_UNAVAILABLE)
+        for i in range(2):
+            request, result = self.render('high')
+            self.assertEquals(result, server.NOT_DONE_YET)
+        request, result = self.render('high')
+        self.assertEquals(request.responseCode, http.SERVICE_UNAVAILABLE)
+        self.clock.advance(0)
+        self.assertEquals(self.calls, ['high', 'high', 'low'])
+
+    def test_request_is_traced(self):
+        request = Request('high', method='PUT')
+        request.content = StringIO('{"a": 1}')
+        self.router.render(request)
+        self.clock.advance(0)
+        self.assertEquals(self.calls, [{'a': 1}])
+        trace, = self.traces
+        self.assertEquals(trace.name, 'PUT /high')
+        self.assertEquals(trace.tags, {'status': 200})
+        self.assertEquals([span.name for span in trace.spans],
+                          ['route', 'queue', 'decode', 'model', 'encode',
+                           'write'])
+        for span in trace.spans:
+            self.assertNotEquals(span.duration, None)
+
+    def test_rate_limited_request_is_traced(self):
+        self.router.rateLimiter = rest.RateLimiter(self.clock, 0.5, 1)
+        self.render('low')
+        self.render('low')
+        self.assertEquals([trace.tags for trace in self.traces],
+                          [{'status': rest.TOO_MANY_REQUESTS}])
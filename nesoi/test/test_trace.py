@@ -0,0 +1,125 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.python import log
+from twisted.web import http
+from twisted.web.test.requesthelper import DummyRequest
+
+from nesoi.api import ProfileResource
+from nesoi.trace import Profiler, Tracer
+
+
+class TracerTestCase(unittest.TestCase):
+    """Test cases for the slow log."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.tracer = Tracer(self.clock, slow_threshold=1)
+        self.events = []
+        log.addObserver(self.events.append)
+        self.addCleanup(log.removeObserver, self.events.append)
+
+    def slow(self):
+        return [event for event in self.events
+                if event.get('format') == 'slow %(trace)s']
+
+    def run_trace(self, seconds, log_slow=True):
+        trace = self.tracer.trace('GET /srv', client='10.0.0.1')
+        trace.log_slow = log_slow
+        span = trace.span('model')
+        self.clock.advance(seconds)
+        span.finish()
+        trace.finish(status=200)
+
+    def test_slow_trace_is_logged(self):
+        self.run_trace(2)
+        event, = self.slow()
+        self.assertEquals(event['name'], 'GET /srv')
+        self.assertEquals(event['duration'], 2)
+        self.assertEquals(event['spans'], {'model': 2})
+        self.assertEquals(event['tags'], {'client': '10.0.0.1',
+                                          'status': 200})
+        self.assertEquals(event['trace'],
+            'GET /srv 2.000s [model=2.000s] client=10.0.0.1 status=200')
+
+    def test_fast_trace_is_not_logged(self):
+        self.run_trace(0.5)
+        self.assertEquals(self.slow(), [])
+
+    def test_trace_can_opt_out_of_slow_log(self):
+        self.run_trace(2, log_slow=False)
+        self.assertEquals(self.slow(), [])
+
+    def test_trace_is_finished_once(self):
+        traces = []
+        self.tracer.add_observer(traces.append)
+        trace = self.tracer.trace('notify')
+        trace.finish(status='delivered')
+        trace.finish(status='failed')
+        self.assertEquals(traces, [trace])
+        self.assertEquals(trace.tags, {'status': 'delivered'})
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """Test cases for the profiler and its resource."""
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.profiler = Profiler(self.clock)
+        self.resource = ProfileResource(self.profiler)
+        self.tracer = Tracer(self.clock)
+
+    def get(self, **args):
+        request = DummyRequest([])
+        request.args = dict((name, [value]) for name, value in args.items())
+        request.trace = self.tracer.trace('GET /_debug/profile')
+        return request, self.resource.get(None, request, None)
+
+    def test_profile_fires_with_stats(self):
+        stats = []
+        self.profiler.profile(1).addCallback(stats.append)
+        self.clock.advance(1)
+        stats, = stats
+        self.assertIn('function calls', stats)
+
+    def test_busy_profiler_refuses(self):
+        self.profiler.profile(1)
+        self.addCleanup(self.clock.advance, 1)
+        self.assertRaises(ValueError, self.profiler.profile, 1)
+
+    def test_resource_returns_stats(self):
+        results = []
+        request, d = self.get(seconds='2')
+        d.addCallback(results.append)
+        self.assertFalse(request.trace.log_slow)
+        self.clock.advance(2)
+        (rc, stats), = results
+        self.assertEquals(rc, http.OK)
+        self.assertIn('function calls', stats)
+        self.assertEquals(request.responseHeaders.getRawHeaders(
+            'content-type'), ['text/plain'])
+
+    def test_resource_rejects_invalid_seconds(self):
+        for seconds in ('x', '0', '-1', '61'):
+            request, result = self.get(seconds=seconds)
+            self.assertEquals(result[0], http.BAD_REQUEST)
+        self.assertEquals(self.profiler._profile, None)
+
+    def test_resource_conflicts_with_running_profile(self):
+        self.profiler.profile(1)
+        self.addCleanup(self.clock.advance, 1)
+        request, result = self.get(seconds='1')
+        self.assertEquals(result[0], http.CONFLICT)
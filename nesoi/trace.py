@@ -0,0 +1,164 @@
+# Copyright 2011 Johan Rydberg
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import cProfile
+import pstats
+from cStringIO import StringIO
+
+from twisted.internet import defer
+from twisted.python import log
+
+
+class Span(object):
+    """A timed step of a L{Trace}."""
+
+    def __init__(self, clock, name):
+        self.clock = clock
+        self.name = name
+        self.start = clock.seconds()
+        self.end = None
+
+    def finish(self, result=None):
+        """Mark the step as done.
+
+        Returns C{result} so that the method can be used as a
+        callback on a deferred.
+        """
+        if self.end is None:
+            self.end = self.clock.seconds()
+        return result
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+
+class Trace(object):
+    """Timed steps (spans) of a single unit of work, such as a
+    request or a notification.
+
+    Set C{log_slow} to C{False} for work that is expected to be slow
+    to keep it out of the slow log.
+    """
+
+    def __init__(self, tracer, name, tags):
+        self.tracer = tracer
+        self.name = name
+        self.tags = tags
+        self.log_slow = True
+        self.spans = []
+        self.start = tracer.clock.seconds()
+        self.end = None
+
+    def span(self, name):
+        """Start a new span called C{name}."""
+        span = Span(self.tracer.clock, name)
+        self.spans.append(span)
+        return span
+
+    def finish(self, result=None, **tags):
+        """Mark the unit of work as done and update the trace with
+        C{tags}.
+
+        Returns C{result} so that the method can be used as a
+        callback on a deferred.
+        """
+        if self.end is None:
+            self.tags.update(tags)
+            self.end = self.tracer.clock.seconds()
+            self.tracer.finished(self)
+        return result
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def describe(self):
+        """Return a one-line summary of the trace."""
+        spans = ' '.join('%s=%.3fs' % (span.name, span.duration)
+                         for span in self.spans if span.end is not None)
+        tags = ' '.join('%s=%s' % item for item in sorted(self.tags.items()))
+        return '%s %.3fs [%s] %s' % (self.name, self.duration, spans, tags)
+
+
+class Tracer(object):
+    """Factory for traces.
+
+    Finished traces are passed to all observers added with
+    L{add_observer}.  Traces that took longer than C{slow_threshold}
+    seconds are logged, unless their C{log_slow} is C{False}.
+    """
+
+    def __init__(self, clock, slow_threshold=None):
+        self.clock = clock
+        self.slow_threshold = slow_threshold
+        self.observers = []
+
+    def add_observer(self, observer):
+        """Add C{observer} to be called with each finished trace."""
+        self.observers.append(observer)
+
+    def trace(self, name, **tags):
+        """Start a new trace called C{name}."""
+        return Trace(self, name, tags)
+
+    def finished(self, trace):
+        for observer in self.observers:
+            observer(trace)
+        if (self.slow_threshold is not None and trace.log_slow
+                and trace.duration >= self.slow_threshold):
+            log.msg(format='slow %(trace)s', trace=trace.describe(),
+                    name=trace.name, duration=trace.duration,
+                    spans=dict((span.name, span.duration)
+                               for span in trace.spans),
+                    tags=trace.tags)
+
+
+class Profiler(object):
+    """Profile the process on demand using C{cProfile}.
+
+    Since all work is done in the reactor thread, this captures
+    everything the process does while the profile is running.
+    """
+
+    def __init__(self, clock, limit=50):
+        self.clock = clock
+        self.limit = limit
+        self._profile = None
+
+    def profile(self, seconds):
+        """Profile the process for C{seconds} seconds.
+
+        @raises ValueError: If a profile is already running.
+        @return: A deferred that fires with the statistics as text.
+        """
+        if self._profile is not None:
+            raise ValueError('a profile is already running')
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        d = defer.Deferred()
+        self.clock.callLater(seconds, self._done, d)
+        return d
+
+    def _done(self, d):
+        profile, self._profile = self._profile, None
+        profile.disable()
+        output = StringIO()
+        stats = pstats.Stats(profile, stream=output)
+        stats.sort_stats('cumulative').print_stats(self.limit)
+        d.callback(output.getvalue())
@@ -28,7 +28,25 @@ class Options(usage.Options):
         ("listen-port", "p", 6553, "The port number to listen on."),
         ("listen-address", "a", None, "The listen address."),
         ("data-file", "d", "nesoi.data", "File to store data in."),
-        ("seed", "s", None, "Address to running Nesoi instance.")
+        ("seed", "s", None, "Address to running Nesoi instance."),
+        ("gossip-interval", None, 1, "Seconds between gossip rounds."),
+        ("gossip-fanout", None, 1, "Peers to gossip with each round."),
+        ("gossip-packet-size", None, 1400,
+         "Maximum size in bytes of a gossip packet."),
+        ("gc-interval", None, 60,
+         "Seconds between garbage collections of deleted keys."),
+        ("gc-grace", None, 86400,
+         "Seconds a dead peer holds back garbage collection."),
+        ("rate-limit", None, 0,
+         "Requests per second allowed per client (0 disables)."),
+        ("rate-burst", None, 20, "Burst of requests allowed per client."),
+        ("slow-threshold", None, 1,
+         "Log requests and notifications slower than this many seconds "
+         "(0 disables).")
+        )
+
+    optFlags = (
+        ("debug", None, "Enable the /_debug endpoints."),
         )
 
 